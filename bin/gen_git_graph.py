@@ -1,10 +1,25 @@
 import typer
 from pathlib import Path
+from typing import Optional, TextIO
+from datetime import datetime, timedelta, timezone
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import pickle
 import re
-import git
+import string
+import subprocess
 import logging
 from rich.logging import RichHandler
 
+try:
+    # optional, reads commits in-process through libgit2 when available
+    import pygit2
+except ImportError:
+    pygit2 = None
+
 logging.basicConfig(
     level=logging.WARN,
     format="%(message)s",
@@ -13,138 +28,355 @@ logging.basicConfig(
 )
 log = logging.getLogger("rich")
 
+# Separators for the `git log` output, chosen so they never show up in commit
+# messages: fields are separated by US (0x1f), records are terminated by RS (0x1e)
+FIELD_SEP = "\x1f"
+RECORD_SEP = "\x1e"
+LOG_FORMAT = FIELD_SEP.join(["%H", "%P", "%an", "%ae", "%cI", "%B"]) + RECORD_SEP
+
+NEWLINES_RE = re.compile(r"[\r\n]+")
+# characters in branch names that are not allowed in JS variable names
+BRANCH_VAR_RE = re.compile(r"[-./]")
+
+# Cached commit graphs, an empty or relative XDG_CACHE_HOME is ignored as the
+# XDG spec requires. Bump the version whenever the graph layout changes
+CACHE_HOME = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+if not CACHE_HOME.is_absolute():
+    CACHE_HOME = Path.home() / ".cache"
+CACHE_DIR = CACHE_HOME / "kiri"
+CACHE_VERSION = 2
+
+
+def run_git(repository_path: Path, *args) -> list[str]:
+    """Run a git command in the repository and return its output lines"""
+    result = subprocess.run(
+        ["git", "-C", str(repository_path), *args],
+        stdout=subprocess.PIPE,
+        encoding="utf-8",
+        check=True,
+    )
+    return result.stdout.splitlines()
+
+
+def ensure_commit_graph(repository_path: Path):
+    """Write git's commit-graph file if the repository doesn't have one yet.
+    It stores the parents and commit date of every commit, which both git log
+    and libgit2 use to walk the history without parsing each commit object"""
+    paths = run_git(
+        repository_path,
+        "rev-parse",
+        "--git-path",
+        "objects/info/commit-graph",
+        "--git-path",
+        "objects/info/commit-graphs",
+    )
+    if any((Path(repository_path) / p).exists() for p in paths):
+        return
+
+    log.info("Writing the commit-graph file")
+    try:
+        run_git(
+            repository_path, "commit-graph", "write", "--reachable", "--no-progress"
+        )
+    except subprocess.CalledProcessError as e:
+        # e.g. a read-only repository, reading the history just takes longer
+        log.warning(f"Could not write the commit-graph file: {e}")
+
+
+def read_git_log(
+    repository_path: Path, max_commits=0, since=None, chunk_size=65536
+):
+    """Yield (hash, parents, author, email, timestamp, message) for every
+    commit reachable from a local branch, using a single `git log` process.
+    The history can be limited to the newest max_commits commits and to the
+    commits after since (any date git understands)"""
+    limits = []
+    if max_commits:
+        limits.append(f"--max-count={max_commits}")
+    if since:
+        limits.append(f"--since={since}")
+
+    proc = subprocess.Popen(
+        [
+            "git",
+            "-C",
+            str(repository_path),
+            "log",
+            # re-encode messages to the encoding the output is decoded with,
+            # whatever i18n.commitEncoding the repository uses
+            "--encoding=UTF-8",
+            # same order as the pygit2 walk, so --max-commits picks the same
+            # commits with both backends
+            "--date-order",
+            "--branches",
+            *limits,
+            f"--format={LOG_FORMAT}",
+        ],
+        stdout=subprocess.PIPE,
+        encoding="utf-8",
+        errors="replace",
+    )
+
+    pending = ""
+    while chunk := proc.stdout.read(chunk_size):
+        records = (pending + chunk).split(RECORD_SEP)
+        # the last record may be incomplete, keep it for the next chunk
+        pending = records.pop()
+        for record in records:
+            hexsha, parents, author, email, timestamp, message = record.lstrip(
+                "\n"
+            ).split(FIELD_SEP)
+            yield (
+                hexsha,
+                parents.split(),
+                author,
+                email,
+                datetime.fromisoformat(timestamp),
+                message,
+            )
 
-def short_hashes(graph: dict, len=7) -> dict:
-    short_graph = {}
-
-    for commit in graph:
-        short_hash = commit[0:len]
-        short_graph[short_hash] = graph[commit]
-        short_graph[short_hash]["parents"] = [
-            p[0:len] for p in graph[commit]["parents"]
-        ]
-        short_graph[short_hash]["children"] = [
-            p[0:len] for p in graph[commit]["children"]
-        ]
-
-    return short_graph
+    proc.stdout.close()
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def read_pygit2_log(repository_path: Path, max_commits=0, since=None):
+    """Same as read_git_log, but walks the history in-process with pygit2"""
+    repo = pygit2.Repository(str(repository_path))
+    walker = repo.walk(None, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_TIME)
+    for name in repo.branches.local:
+        walker.push(repo.branches.local[name].target)
+
+    commits = iter(walker)
+    if since:
+        # let git parse the date, it prints it back as --max-age=<timestamp>
+        (max_age,) = run_git(repository_path, "rev-parse", f"--since={since}")
+        max_age = int(max_age.removeprefix("--max-age="))
+        commits = (c for c in commits if c.commit_time >= max_age)
+    if max_commits:
+        commits = itertools.islice(commits, max_commits)
+
+    for commit in commits:
+        tz = timezone(timedelta(minutes=commit.commit_time_offset))
+        yield (
+            str(commit.id),
+            [str(p) for p in commit.parent_ids],
+            commit.author.name,
+            commit.author.email,
+            datetime.fromtimestamp(commit.commit_time, tz),
+            commit.message,
+        )
 
 
-def generate_commit_graph(repository_path: Path) -> tuple[dict, str]:
+def short_hashes(graph: dict, len=7) -> dict:
+    """Return a copy of the graph keyed by abbreviated hashes, leaving the
+    entries of the original graph untouched"""
+    return {
+        commit[0:len]: {
+            **details,
+            "parents": [p[0:len] for p in details["parents"]],
+            "children": [c[0:len] for c in details["children"]],
+        }
+        for commit, details in graph.items()
+    }
+
+
+def generate_commit_graph(
+    repository_path: Path, max_commits=0, since=None
+) -> tuple[dict, list[str]]:
     graph = {}
-
-    # Open the Git repository
-    repo = git.Repo(repository_path)
-
-    head = repo.head  # the head points to the active branch/ref
-    master = head.reference  # retrieve the reference the head points to
-    # master.commit  # from here you use it as any other reference
-
-    # graph["master"] = {"parents": [master.commit.hexsha]}
-
+    # commits without parents, i.e. the initial commit(s)
+    roots = []
+
+    ensure_commit_graph(repository_path)
+
+    # Add a vertex for each commit, walking the history of all branches at once
+    read_log = read_pygit2_log if pygit2 else read_git_log
+    for hexsha, parents, author, email, timestamp, message in read_log(
+        repository_path, max_commits, since
+    ):
+        message = message.strip()
+        subject = message.splitlines()[0] if message else ""
+        graph[hexsha] = {
+            # a commit can name the same parent twice, keep it once
+            "parents": list(dict.fromkeys(parents)),
+            "subject": subject,
+            "message": message,
+            "author": author,
+            "email": email,
+            "timestamp": timestamp,
+            "tag": "",
+            "children": [],
+            "branches": [],
+            "branch": "",
+            "body": NEWLINES_RE.sub("\n", message.removeprefix(subject).strip()),
+        }
+        if not parents:
+            roots.append(hexsha)
+
+    # add tags, annotated tags are peeled to the commit they point to
+    for line in run_git(
+        repository_path,
+        "for-each-ref",
+        "--format=%(if)%(*objectname)%(then)%(*objectname)%(else)%(objectname)%(end) %(refname:lstrip=2)",
+        "refs/tags",
+    ):
+        hexsha, tag = line.split(" ", 1)
+        if hexsha in graph:
+            graph[hexsha]["tag"] = tag
+
+    # branch heads as (name, hash), listed once instead of walking each branch
     heads = []
-    for head in repo.branches:
-        # name = re.sub(r"^" + re.escape("refs/heads/"), "", head.ref.name)
-        # heads += [head.ref.name]
-        # graph[head.commit.hexsha]["branches"] += [head.ref.name]
-
-        # Add a vertex for each commit
-        for commit in repo.iter_commits(rev=head.commit):
-            graph[commit.hexsha] = {
-                "parents": [p.hexsha for p in commit.parents],
-                "subject": commit.message.strip().splitlines()[0],
-                "message": commit.message.strip(),
-                "author": commit.author.name,
-                "email": commit.author.email,
-                "timestamp": commit.committed_datetime,
-                "tag": "",
-                "children": [],
-                "branches": [],
-                "branch": "",
-            }
-            graph[commit.hexsha]["body"] = re.sub(
-                "[\r\n]+",
-                "\n",
-                commit.message.removeprefix(graph[commit.hexsha]["subject"]).strip(),
-            )
-
-    # add children for each commit
-    for commit in graph:
-        for parent in graph[commit]["parents"]:
-            if commit not in graph[parent]["children"]:
-                graph[parent]["children"] += [commit]
-                if commit.startswith("2822155"):
-                    log.debug(
-                        f"Setting commit {parent} to children {graph[parent]['children']}"
-                    )
-
-    # add tags
-    for tag in repo.tags:
-        graph[tag.commit.hexsha]["tag"] = tag.name
-
-    # add branch names
-    commit = master.commit
-    while True:
-        graph[commit.hexsha]["branch"] = master.name
-        # first parent follows the branch (I think)
-        if commit.parents:
-            commit = commit.parents[0]
-        else:
-            break
-
-    for head in repo.branches:
-        commit = head.commit
-        while True:
-            if graph[commit.hexsha]["branch"]:
-                break
-            graph[commit.hexsha]["branch"] = head.name
-            # first parent follows the branch (I think)
-            if commit.parents:
-                commit = commit.parents[0]
-            else:
-                break
+    for line in run_git(
+        repository_path,
+        "for-each-ref",
+        "--format=%(objectname) %(refname:lstrip=2)",
+        "refs/heads",
+    ):
+        hexsha, name = line.split(" ", 1)
+        heads.append((name, hexsha))
+
+    # the branch the head points to, "HEAD" if it is detached
+    (master,) = run_git(repository_path, "rev-parse", "--symbolic-full-name", "HEAD")
+    master = master.removeprefix("refs/heads/")
+
+    # add branch names by following the first parent (which follows the
+    # branch, I think) until a commit that already has one. The checked out
+    # branch goes first so its history is never claimed by another branch.
+    for name, commit in sorted(heads, key=lambda head: head[0] != master):
+        while commit in graph and not graph[commit]["branch"]:
+            graph[commit]["branch"] = name
+            parents = graph[commit]["parents"]
+            commit = parents[0] if parents else None
 
-    for head in repo.branches:
-        # name = re.sub(r"^" + re.escape("refs/heads/"), "", head.ref.name)
-        commit = head.commit
-        graph[commit.hexsha]["branches"] += [head.name]
+    for name, commit in heads:
+        if commit in graph:
+            graph[commit]["branches"].append(name)
 
-    # find initial commit
-    initial_commit = {"timestamp": master.commit.committed_datetime, "hash": []}
+    # add children for each commit, every commit is visited once and its
+    # parents are unique, so a child is never listed twice
     for commit, details in graph.items():
-        if "timestamp" not in details:
-            continue
-        if details["timestamp"] < initial_commit["timestamp"]:
-            initial_commit["timestamp"] = details["timestamp"]
-            initial_commit["hash"] = commit
+        if max_commits or since:
+            # the history is cut off, drop parents that were not read and
+            # start drawing from the commits that lost all of them. This is
+            # done after the branch walk, which has to see the original
+            # first parent to stay on the right branch
+            parents = [p for p in details["parents"] if p in graph]
+            if details["parents"] and not parents:
+                roots.append(commit)
+            details["parents"] = parents
+        for parent in details["parents"]:
+            graph[parent]["children"].append(commit)
+
+    return (graph, roots)
+
+
+def cached_commit_graph(
+    repository_path: Path, max_commits=0, since=None
+) -> tuple[dict, list[str]]:
+    """Same as generate_commit_graph, but reuses the graph from a previous
+    run as long as no branch, tag or the checked out branch has changed"""
+    repository_path = Path(repository_path).resolve()
+
+    refs = run_git(
+        repository_path,
+        "for-each-ref",
+        "--format=%(objectname) %(refname)",
+        "refs/heads",
+        "refs/tags",
+    )
+    refs += run_git(repository_path, "rev-parse", "--symbolic-full-name", "HEAD")
+    if since:
+        # relative dates move on, key on the timestamp git resolves them to
+        refs += run_git(repository_path, "rev-parse", f"--since={since}")
+    refs += [
+        f"version={CACHE_VERSION}",
+        f"max_commits={max_commits}",
+        f"backend={'pygit2' if pygit2 else 'git'}",
+    ]
+
+    repo_key = hashlib.blake2b(str(repository_path).encode(), digest_size=8)
+    refs_key = hashlib.blake2b("\n".join(refs).encode(), digest_size=16)
+    cache_file = CACHE_DIR / f"graph-{repo_key.hexdigest()}-{refs_key.hexdigest()}.pkl"
+
+    try:
+        with open(cache_file, "rb") as f:
+            cached = pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        # unpickling garbage can raise about anything, rebuild the cache
+        log.warning(f"Ignoring unreadable cached commit graph {cache_file}: {e}")
+        cache_file.unlink(missing_ok=True)
+    else:
+        if (
+            isinstance(cached, tuple)
+            and len(cached) == 2
+            and isinstance(cached[0], dict)
+            and isinstance(cached[1], list)
+        ):
+            log.info(f"Using cached commit graph {cache_file}")
+            return cached
+        log.warning(f"Ignoring invalid cached commit graph {cache_file}")
+        cache_file.unlink(missing_ok=True)
+
+    graph, roots = generate_commit_graph(repository_path, max_commits, since)
+
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # only keep the latest graph of each repository
+        for old_file in CACHE_DIR.glob(f"graph-{repo_key.hexdigest()}-*.pkl"):
+            old_file.unlink()
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, "wb") as f:
+            pickle.dump((graph, roots), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        log.warning(f"Could not cache the commit graph: {e}")
+
+    return (graph, roots)
+
+
+# JS emitted for every commit, compiled once: its tooltip text is stored in the
+# commit_details lookup table, and the commit handlers refer to it by hash. All
+# fields are expected to be JS literals already, see js_str()
+COMMIT_OPTIONS = (
+    "{subject: $subject, "
+    "onMouseOver: () => show_commit_details(commit_details[$hash]), "
+    "onMouseOut: hide_commit_details, "
+    "onClick: () => commit_click($hash), "
+    "onMessageClick: () => commit_click($hash), "
+    "author: $author, "
+    "timestamp: $timestamp, "
+    "hash: $hash, tag: $tag}"
+)
+COMMIT_DETAILS = "commit_details[$hash] = $tooltip;\n"
+BRANCH_JS = string.Template("const $branch_var = $parent_branch_var.branch($branch);\n")
+COMMIT_JS = string.Template(
+    COMMIT_DETAILS + "$branch_var.commit(" + COMMIT_OPTIONS + ");\n"
+)
+MERGE_JS = string.Template(
+    COMMIT_DETAILS
+    + "$branch_var.merge({branch: $src_branch_var, commitOptions: "
+    + COMMIT_OPTIONS
+    + "})$tag_str;\n"
+)
 
-    return (graph, initial_commit["hash"])
+
+def js_str(value) -> str:
+    """Encode a value as a JS string literal, escaping quotes, backticks and
+    newlines, and "</" so it can't close the surrounding <script> tag"""
+    return json.dumps(str(value)).replace("</", "<\\/")
 
 
 def gitgraph_branch_var(branch: str) -> str:
-    branch_var = "b_" + branch.replace("-", "_").replace(".", "_").replace(
-        ".", "_"
-    ).replace("/", "_")
+    branch_var = "b_" + BRANCH_VAR_RE.sub("_", branch)
     return branch_var
 
 
-def select_next_child(graph: dict, children_remaining: list) -> tuple[list, str]:
-    children = {}
-
-    for c in children_remaining:
-        children[c] = graph[c]
-
-    oldest_child = children_remaining[0]
-
-    for c in children_remaining[1:]:
-        if graph[oldest_child]["timestamp"] > graph[c]["timestamp"]:
-            oldest_child = c
-
-    children_remaining.remove(oldest_child)
-    return (children_remaining, oldest_child)
-
-
-def commit_graph_to_gitgraph_js(graph: dict, initial_commit: str) -> str:
+def commit_graph_to_gitgraph_js(graph: dict, roots: list[str], out: TextIO):
+    """Write the gitgraph.js code drawing the commit graph to out, one
+    fragment at a time so the whole script is never held in memory"""
     template = """
         gitgraph_template = GitgraphJS.templateExtend(GitgraphJS.TemplateName.Metro,
         {
@@ -172,41 +404,53 @@ def commit_graph_to_gitgraph_js(graph: dict, initial_commit: str) -> str:
                 },
             },
         });"""
-    gitgraph_js = template
-    gitgraph_js += """
+    header = """
         const gitgraph = GitgraphJS.createGitgraph(document.getElementById("gitGraphContainer"), {
             mode: "extended",
             template: gitgraph_template,
-        });"""
-
-    commit = initial_commit
+        });
+        const commit_details = {};
+"""
+    out.write(template)
+    out.write(header)
 
     created_branches = {}
-    children_remaining = []
-    commits_parsed = []
-    # find initial commit
-    while commit:
+
+    # Kahn's algorithm: a commit is emitted once all of its parents have been,
+    # so every commit is visited exactly once. Commits that are ready are kept
+    # in a heap of (timestamp, hash) so the oldest one is emitted first.
+    # parents are counted once, like the children lists are built, so a
+    # commit naming the same parent twice still becomes ready
+    parents_remaining = {c: len(set(graph[c]["parents"])) for c in graph}
+    commits_ready = [(graph[c]["timestamp"], c) for c in roots]
+    heapq.heapify(commits_ready)
+
+    commits_emitted = 0
+    while commits_ready:
+        _, commit = heapq.heappop(commits_ready)
+        commits_emitted += 1
+        entry = graph[commit]
+        branch_name = entry["branch"]
+        parents = entry["parents"]
+        children = entry["children"]
+
         log.debug(f"Parsing commit {commit}")
         log.debug(f"\tParents:")
-        for parent in graph[commit]["parents"]:
+        for parent in parents:
             log.debug("\t\t" + parent)
         log.debug(f"\tChildren:")
-        for child in graph[commit]["children"]:
-            log.debug("\t\t" + child)
-        log.debug(f"\tChildren remaining:")
-        for child in children_remaining:
+        for child in children:
             log.debug("\t\t" + child)
 
         # Create the .tag JS string
-        if graph[commit]["tag"]:
-            tag_str = f'.tag("{graph[commit]["tag"]}")'
+        if entry["tag"]:
+            tag_str = f'.tag({js_str(entry["tag"])})'
         else:
             tag_str = ""
 
         # Create branch if it doesn't exist yet
-        branch_var = gitgraph_branch_var(graph[commit]["branch"])
-        if graph[commit]["branch"] not in created_branches:
-            parents = graph[commit]["parents"]
+        branch_var = gitgraph_branch_var(branch_name)
+        if branch_name not in created_branches:
             if len(parents) == 0:
                 # initial commit, use the method from gitgraph
                 parent_branch_var = "gitgraph"
@@ -214,63 +458,45 @@ def commit_graph_to_gitgraph_js(graph: dict, initial_commit: str) -> str:
                 # else branch off the parent branch
                 parent_branch = graph[parents[0]]["branch"]
                 parent_branch_var = created_branches[parent_branch]
-            created_branches[graph[commit]["branch"]] = branch_var
+            created_branches[branch_name] = branch_var
             log.info(f"Creating branch {branch_var}")
-            gitgraph_js += f'const {branch_var} = {parent_branch_var}.branch("{graph[commit]["branch"]}");\n'
-
-        # Create commit options for gitgraph
-        # commit_options = f'{{subject: "{graph[commit]["subject"]}", body: `{graph[commit]["body"]}`, author: "{graph[commit]["author"]} <{graph[commit]["email"]}>", timestamp: "{graph[commit]["timestamp"]}", hash: "{commit}", tag: "{graph[commit]["tag"]}"}}'
-        timestamp_str = str(graph[commit]["timestamp"])
-        line_separator = "-" * max(len(graph[commit]["author"]), len(graph[commit]["email"]), len(timestamp_str))
-        tooltip = f"""{graph[commit]["author"]}\n{graph[commit]["email"]}\non {timestamp_str}\n\n{line_separator}\n\n{graph[commit]["message"]}"""
-        gitgraph_js += f"""function show_commit_details_{commit}(){{
-                show_commit_details(`{tooltip}`)
-            }}
-            """
-        gitgraph_js += f"""function commit_click_{commit}(){{
-                commit_click("{commit}", gitgraph)
-            }}
-            """
-        commit_options = f"""{{subject: "{graph[commit]["subject"]}",
-                            onMouseOver: show_commit_details_{commit},
-                            onMouseOut: hide_commit_details,
-                            onClick: commit_click_{commit},
-                            onMessageClick: commit_click_{commit},
-                            author: "{graph[commit]["author"]} <{graph[commit]["email"]}>",
-                            timestamp: "{graph[commit]["timestamp"]}",
-                            hash: "{commit}", tag: "{graph[commit]["tag"]}"}}
-                            """
+            out.write(
+                BRANCH_JS.substitute(
+                    branch_var=branch_var,
+                    parent_branch_var=parent_branch_var,
+                    branch=js_str(branch_name),
+                )
+            )
+
+        # Tooltip shown when hovering over the commit
+        timestamp_str = str(entry["timestamp"])
+        line_separator = "-" * max(len(entry["author"]), len(entry["email"]), len(timestamp_str))
+        tooltip = f"""{entry["author"]}\n{entry["email"]}\non {timestamp_str}\n\n{line_separator}\n\n{entry["message"]}"""
+
+        # Commit fields, encoded as JS literals
+        fields = {
+            "hash": js_str(commit),
+            "subject": js_str(entry["subject"]),
+            "author": js_str(f'{entry["author"]} <{entry["email"]}>'),
+            "timestamp": js_str(timestamp_str),
+            "tag": js_str(entry["tag"]),
+            "tooltip": js_str(tooltip),
+        }
 
         # Create the commit
-        if len(graph[commit]["parents"]) <= 1:
+        if len(parents) <= 1:
             # Create a single commit if just has one parent
             log.info(f"Adding commit {commit} on branch {branch_var}")
-            gitgraph_js += f"{branch_var}.commit({commit_options});\n"
-        elif len(graph[commit]["parents"]) == 2:
+            out.write(COMMIT_JS.substitute(fields, branch_var=branch_var))
+        elif len(parents) == 2:
             # Create a merge commit if it has two parents
-            parents = graph[commit]["parents"]
             parent_branches = [graph[parent]["branch"] for parent in parents]
-            if parents[0] not in commits_parsed or parents[1] not in commits_parsed:
-                # if either of the parent commits isn't created yet, wait for that branch to catch up
-                if len(children_remaining) == 0:
-                    log.error(f"Merge commit with orphaned commit? {commit}")
-                    break
-                else:
-                    log.debug(
-                        f"Branch {graph[commit]['branch']} blocked by merge commit {commit}, waiting for commit {[c for c in parents if c not in commits_parsed]}"
-                    )
-                    children_remaining, commit = select_next_child(
-                        graph, children_remaining
-                    )
-                    # commits_parsed += commit
-                    continue
-
-            log.debug(f"Branch {graph[commit]['branch']} unblocked, merging")
-
-            if parent_branches[1] == graph[commit]["branch"]:
+            log.debug(f"Branch {branch_name} merging")
+
+            if parent_branches[1] == branch_name:
                 src_branch_var = gitgraph_branch_var(parent_branches[0])
                 tgt_branch_var = gitgraph_branch_var(parent_branches[1])
-            elif parent_branches[0] == graph[commit]["branch"]:
+            elif parent_branches[0] == branch_name:
                 src_branch_var = gitgraph_branch_var(parent_branches[1])
                 tgt_branch_var = gitgraph_branch_var(parent_branches[0])
             else:
@@ -279,33 +505,51 @@ def commit_graph_to_gitgraph_js(graph: dict, initial_commit: str) -> str:
                 )
 
             log.info(f"Adding commit {commit} on branch {tgt_branch_var}")
-            gitgraph_js += f"{tgt_branch_var}.merge({{branch: {src_branch_var}, commitOptions: {commit_options}}}){tag_str};\n"
+            out.write(
+                MERGE_JS.substitute(
+                    fields,
+                    branch_var=tgt_branch_var,
+                    src_branch_var=src_branch_var,
+                    tag_str=tag_str,
+                )
+            )
         else:
             log.error(f"More than 2 parents for commit {commit}")
 
-        commits_parsed += [commit]
-
-        for child in graph[commit]["children"]:
-            if child not in children_remaining:
-                children_remaining += [child]
-
-        if len(children_remaining) == 0:
-            break
-
-        children_remaining, commit = select_next_child(graph, children_remaining)
-
-    return gitgraph_js
-
-
-def main(git_dir: Path, output_file: typer.FileTextWrite):
+        for child in children:
+            parents_remaining[child] -= 1
+            if parents_remaining[child] == 0:
+                heapq.heappush(commits_ready, (graph[child]["timestamp"], child))
+
+    if commits_emitted < len(graph):
+        log.error(
+            f"Only {commits_emitted} of {len(graph)} commits were drawn, "
+            "the others are waiting on parents that were never drawn"
+        )
+
+
+def main(
+    git_dir: Path,
+    output_file: typer.FileTextWrite,
+    max_commits: int = typer.Option(
+        0, min=0, help="Only draw the newest N commits, 0 draws all of them"
+    ),
+    since: Optional[str] = typer.Option(
+        None, help='Only draw commits newer than this date, e.g. "6 months ago"'
+    ),
+    cache: bool = typer.Option(
+        True, help="Reuse the commit graph of a previous run if nothing changed"
+    ),
+):
     # Generate the commit graph
-    graph, initial_commit = generate_commit_graph(git_dir)
+    if cache:
+        graph, roots = cached_commit_graph(git_dir, max_commits, since)
+    else:
+        graph, roots = generate_commit_graph(git_dir, max_commits, since)
     hash_len = 7
-    graph = short_hashes(graph)
-    initial_commit = initial_commit[0:hash_len]
-    js = commit_graph_to_gitgraph_js(graph, initial_commit)
-
-    output_file.write(js)
+    graph = short_hashes(graph, hash_len)
+    roots = [r[0:hash_len] for r in roots]
+    commit_graph_to_gitgraph_js(graph, roots, output_file)
 
     exit()
 